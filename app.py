@@ -1,49 +1,154 @@
-import os, io, time, json, requests, re
+import os, io, json, requests, tempfile, hashlib, threading
+import orjson
 import streamlit as st
 import streamlit.components.v1 as components
 import fitz # PyMuPDF
 from PIL import Image
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_path
 import pytesseract
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ProcessPoolExecutor
+import ocr_worker
 
 # ──────────────────────────────────────────────────────────────────────────────
 # CONFIG
 # ──────────────────────────────────────────────────────────────────────────────
+# OpenMP thread count for the tesseract processes pytesseract spawns (they inherit this environment).
+# Single runs such as an uploaded image may use up to 4 threads; ocr_worker.init_worker drops it to 1
+# inside the process pool, where one Tesseract per core plus its own threads would oversubscribe the
+# CPU and run slower. setdefault keeps any limit the deployment already sets.
+os.environ.setdefault("OMP_THREAD_LIMIT", "4")
+
 # Use st.secrets to securely manage the API key for public deployment
 try:
     GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
 except KeyError:
+    GEMINI_API_KEY = ""
+# Stop before any extraction or prompt building; a blank key would only fail once the request is sent.
+if not GEMINI_API_KEY:
     st.error("API key not found. Please add it to your Streamlit secrets.")
     st.stop()
     
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent"
+GEMINI_ENDPOINT = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}"
 HERO_BACKGROUND_IMAGE_URL = "https://images.unsplash.com/photo-1518709268805-4e9042af2176?ixlib=rb-4.0.3&auto=format&fit=crop&w=2000&q=80"
+OCR_LANGS = (("English","eng"),("Spanish","spa"),("French","fra"),("Tamil","tam"),("Auto-detect","auto"))
+OCR_LANG_NAMES = [name for name, _ in OCR_LANGS]
+OCR_LANG_MAP = dict(OCR_LANGS)
+RAW_TEXT_DISPLAY_CHARS = 20_000  # longer extractions are truncated on screen and offered as a download
 
 # ──────────────────────────────────────────────────────────────────────────────
 # BACKEND: extraction (PyMuPDF → OCR fallback)
 # ──────────────────────────────────────────────────────────────────────────────
-@st.cache_data(show_spinner=False)
-def _extract_text_from_pdf(file_bytes: bytes) -> str | None:
+MIN_PAGE_TEXT_CHARS = 5  # pages with less extractable text than this are treated as scanned
+# MuPDF OCRs one page at a time in the script thread; scans with more textless pages than this go to the per-core pool.
+MUPDF_OCR_MAX_PAGES = 2
+# Tesseract rescales text to a fixed x-height internally, so larger or colour input only costs time and memory.
+OCR_DPI = 200
+OCR_MAX_IMAGE_SIDE = 2500
+EXTRACTION_CACHE_ENTRIES = 64  # per extractor; bounds server RSS when many users upload large scans
+
+@st.cache_resource(show_spinner=False)
+def _mupdf_tessdata() -> str | None:
+    """Tesseract language data for MuPDF's built-in OCR, or None if this build cannot OCR."""
+    try:
+        return fitz.get_tessdata() or None
+    except AttributeError:  # older PyMuPDF without get_tessdata()
+        return os.environ.get("TESSDATA_PREFIX")
+    except Exception:
+        return None
+
+def _mupdf_ocr_tessdata(ocr_language: str) -> str | None:
+    """The tessdata directory if MuPDF can OCR `ocr_language` in-process, else None."""
+    tessdata = _mupdf_tessdata()
+    if tessdata and all(os.path.isfile(os.path.join(tessdata, f"{lang}.traineddata")) for lang in ocr_language.split("+")):
+        return tessdata
+    return None
+
+def _mupdf_ocr_page(page: fitz.Page, ocr_language: str, tessdata: str) -> str | None:
+    try:
+        tp = page.get_textpage_ocr(language=ocr_language, dpi=OCR_DPI, full=True, tessdata=tessdata)
+        return page.get_text(textpage=tp)
+    except Exception:
+        return None
+
+def _nonspace_len(text: str) -> int:
+    return len("".join(text.split()))
+
+@st.cache_data(show_spinner=False, max_entries=EXTRACTION_CACHE_ENTRIES)
+def _extract_text_from_pdf(digest: str, _file_bytes: bytes, ocr_language: str) -> tuple[list[str], list[int]] | None:
+    """Per-page text plus the indices of pages still without text, or None if PyMuPDF cannot read the file.
+
+    A few textless pages are OCR'd in-process from MuPDF's own rendering when it has data for `ocr_language`;
+    larger scans, and any page whose OCR fails, are left for the parallel Poppler + Tesseract pass.
+    """
     try:
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        text = "".join(doc.load_page(p).get_text() for p in range(doc.page_count))
-        doc.close()
-        return text if len(text.strip()) > 50 else None
+        doc = fitz.open(stream=_file_bytes, filetype="pdf")
+        try:
+            pages = [page.get_text("text", sort=False, flags=fitz.TEXTFLAGS_TEXT) for page in doc]
+            empty = [i for i, t in enumerate(pages) if _nonspace_len(t) < MIN_PAGE_TEXT_CHARS]
+            tessdata = _mupdf_ocr_tessdata(ocr_language) if len(empty) <= MUPDF_OCR_MAX_PAGES else None
+            unread = []
+            for i in empty:
+                ocr_text = _mupdf_ocr_page(doc[i], ocr_language, tessdata) if tessdata else None
+                if ocr_text is None: unread.append(i)
+                else: pages[i] = ocr_text
+        finally:
+            doc.close()
+        return pages, unread
     except Exception:
         return None
 
-@st.cache_data(show_spinner=False)
-def _ocr_pdf(file_bytes: bytes, ocr_language: str) -> str | None:
+@st.cache_data(show_spinner=False, max_entries=EXTRACTION_CACHE_ENTRIES)
+def _ocr_pdf(digest: str, _file_bytes: bytes, ocr_language: str, pages: tuple[int, ...] | None) -> list[str] | None:
+    """OCRs the given 0-based pages (all pages if None), returning their text in the same order."""
     try:
-        images = convert_from_bytes(file_bytes)
-        return "".join(pytesseract.image_to_string(im, lang=ocr_language) for im in images)
+        # Pages are rendered to disk and only their paths cross into the pool, so at most one decoded page per worker is resident.
+        with tempfile.TemporaryDirectory() as td:
+            # Write the PDF once; convert_from_bytes would re-write the whole file for every Poppler call.
+            pdf_path = os.path.join(td, "input.pdf")
+            with open(pdf_path, "wb") as f:
+                f.write(_file_bytes)
+            # Render consecutive page numbers with one Poppler call each rather than one call per page.
+            runs = [[None, None]] if pages is None else []
+            for i in pages or ():
+                if runs and runs[-1][1] == i: runs[-1][1] = i + 1
+                else: runs.append([i, i + 1])
+            paths = []
+            for start, stop in runs:
+                paths += convert_from_path(pdf_path, dpi=OCR_DPI, grayscale=True,
+                                           first_page=None if start is None else start + 1, last_page=stop,
+                                           output_folder=td, output_file=f"p{start or 0:05d}", fmt="png",
+                                           paths_only=True, thread_count=os.cpu_count() or 1)
+            if not paths: return []
+            # Each worker gets one contiguous run of pages as a Tesseract list file, so Tesseract initialises once per worker, not per page.
+            workers = max(1, min(len(paths), os.cpu_count() or 1))
+            size = -(-len(paths) // workers)
+            lists = []
+            for k in range(0, len(paths), size):
+                list_path = os.path.join(td, f"chunk_{k // size}.txt")
+                with open(list_path, "w") as f:
+                    f.write("\n".join(paths[k:k + size]) + "\n")
+                lists.append(list_path)
+            with ProcessPoolExecutor(max_workers=workers, initializer=ocr_worker.init_worker,
+                                     initargs=(ocr_language, pytesseract.pytesseract.tesseract_cmd)) as ex:
+                return [text for chunk in ex.map(ocr_worker.ocr_page_list, lists, chunksize=1) for text in chunk]
     except Exception:
         return None
 
-@st.cache_data(show_spinner=False)
-def _ocr_image(file_bytes: bytes, ocr_language: str) -> str | None:
+@st.cache_data(show_spinner=False, max_entries=EXTRACTION_CACHE_ENTRIES)
+def _ocr_image(digest: str, _file_bytes: bytes, ocr_language: str) -> str | None:
     try:
-        image = Image.open(io.BytesIO(file_bytes))
+        image = Image.open(io.BytesIO(_file_bytes))
+        # Flatten transparency onto white first (as pytesseract itself would); converting straight to L drops alpha
+        # and leaves a transparent background black.
+        if "A" in image.getbands() or (image.mode == "P" and "transparency" in image.info):
+            image = image.convert("RGBA")
+            image = Image.alpha_composite(Image.new("RGBA", image.size, (255, 255, 255, 255)), image)
+        image = image.convert("L")
+        if max(image.size) > OCR_MAX_IMAGE_SIDE:
+            image.thumbnail((OCR_MAX_IMAGE_SIDE, OCR_MAX_IMAGE_SIDE), Image.LANCZOS)
         return pytesseract.image_to_string(image, lang=ocr_language)
     except Exception:
         return None
@@ -51,27 +156,38 @@ def _ocr_image(file_bytes: bytes, ocr_language: str) -> str | None:
 def extract_text_from_document(uploaded_file: io.BytesIO, file_type: str, ocr_language: str) -> str:
     """Combines different extraction methods with a clear fallback logic."""
     try:
-        file_bytes = uploaded_file.read()
+        # getvalue() hands back the upload's own bytes object without copying, whatever the stream position;
+        # getbuffer() would force a full copy to make the buffer writable.
+        file_bytes = uploaded_file.getvalue()
     except Exception as e:
         st.error("Failed to read uploaded file. Please ensure it is not corrupted."); return ""
     
     ocr_lang_code = ocr_language if ocr_language.lower() != "auto" else "eng"
+    # The extractors' caches key on this digest; Streamlit skips hashing their underscore-prefixed bytes argument.
+    digest = hashlib.sha256(file_bytes).hexdigest()
 
     with st.status(f"Extracting text from {file_type.split('/')[-1].upper()}…") as status_container:
         if file_type == "application/pdf":
-            status_container.update(label="Attempting direct text extraction…", state="running")
-            text = _extract_text_from_pdf(file_bytes)
-            if text:
-                status_container.update(label="Direct PDF extraction successful.", state="complete", expanded=False); return text
-            
-            status_container.update(label=f"Direct extraction failed. Starting OCR (lang: {ocr_lang_code})…", state="running")
-            text = _ocr_pdf(file_bytes, ocr_lang_code)
-            if text and text.strip():
-                status_container.update(label="OCR extraction successful.", state="complete", expanded=False); return text
+            status_container.update(label=f"Extracting text, OCR for scanned pages (lang: {ocr_lang_code})…", state="running")
+            extracted = _extract_text_from_pdf(digest, file_bytes, ocr_lang_code)
+            # Pages MuPDF could not read or OCR go to Poppler + Tesseract; if PyMuPDF could not open the file, all of them do.
+            pages, unread = extracted if extracted is not None else (None, None)
+            if pages is None or unread:
+                label = "Direct extraction failed. Starting OCR" if pages is None else f"OCR for {len(unread)} scanned page(s)"
+                status_container.update(label=f"{label} (lang: {ocr_lang_code})…", state="running")
+                ocr_texts = _ocr_pdf(digest, file_bytes, ocr_lang_code, None if pages is None else tuple(unread))
+                if pages is None:
+                    pages = ocr_texts or []
+                elif ocr_texts:
+                    pages = list(pages)
+                    for i, t in zip(unread, ocr_texts): pages[i] = t
+            text = "".join(pages)
+            if _nonspace_len(text) > 50:
+                status_container.update(label="PDF extraction successful.", state="complete", expanded=False); return text
 
         elif file_type.startswith("image/"):
             status_container.update(label=f"Starting OCR for image (lang: {ocr_lang_code})…", state="running")
-            text = _ocr_image(file_bytes, ocr_lang_code)
+            text = _ocr_image(digest, file_bytes, ocr_lang_code)
             if text and text.strip():
                 status_container.update(label="OCR extraction successful.", state="complete", expanded=False); return text
 
@@ -84,32 +200,58 @@ def extract_text_from_document(uploaded_file: io.BytesIO, file_type: str, ocr_la
 # BACKEND: Gemini call
 # ──────────────────────────────────────────────────────────────────────────────
 @st.cache_resource(show_spinner=False)
-def call_gemini_api(prompt: str, response_schema: dict | None = None, max_retries: int = 4) -> str | None:
-    """Makes a request to the Gemini API with retry logic and caching."""
-    headers = {"Content-Type": "application/json"}
+def _gemini_session() -> requests.Session:
+    """One pooled session per server process, so reruns and retries reuse the TLS connection."""
+    session = requests.Session()
+    retry = Retry(total=4, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["POST"])
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+    return session
+
+_SESSION = _gemini_session()
+
+def _prewarm_gemini_connection() -> None:
+    """Opens a pooled connection to Gemini in the background, so the TCP+TLS handshake overlaps text extraction."""
+    def _head():
+        try: _SESSION.head("https://generativelanguage.googleapis.com/", timeout=(10, 10))
+        except requests.exceptions.RequestException: pass
+    threading.Thread(target=_head, daemon=True).start()
+
+class _GeminiCallFailed(Exception):
+    """Raised out of the cached call so that failures are reported but never cached."""
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=256)
+def _call_gemini_api(prompt: str, response_schema_json: str | None) -> str:
     payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
-    if response_schema:
-        payload["generationConfig"] = {"responseMimeType": "application/json", "responseSchema": response_schema}
+    if response_schema_json:
+        payload["generationConfig"] = {"responseMimeType": "application/json", "responseSchema": orjson.loads(response_schema_json)}
     
     with st.spinner("Connecting to Gemini API..."):
-        for attempt in range(max_retries):
-            try:
-                url = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}"
-                resp = requests.post(url, headers=headers, data=json.dumps(payload), timeout=90)
-                resp.raise_for_status()
-                data = resp.json()
-                parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
-                if parts:
-                    return parts[0].get("text", "")
-                st.error(f"Unexpected API response: {json.dumps(data)[:500]}"); return None
-            except requests.exceptions.RequestException as e:
-                if attempt < max_retries - 1:
-                    wait = 2 ** attempt; time.sleep(wait)
-                else:
-                    st.error("Gemini API failed after retries."); return None
-            except Exception as e:
-                st.error("Unexpected error calling Gemini."); st.exception(e); return None
-    return None
+        try:
+            # orjson encodes straight to bytes and parses the raw body, skipping the str copies json=/resp.json() make.
+            resp = _SESSION.post(GEMINI_ENDPOINT, data=orjson.dumps(payload), headers={"Content-Type": "application/json"},
+                                 timeout=(10, 90))
+            resp.raise_for_status()
+            data = orjson.loads(resp.content)
+            parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+            if parts:
+                return parts[0].get("text", "")
+            st.error(f"Unexpected API response: {resp.content[:500].decode('utf-8', 'replace')}")
+        except requests.exceptions.RequestException:
+            st.error("Gemini API failed after retries.")
+        except Exception as e:
+            st.error("Unexpected error calling Gemini."); st.exception(e)
+    raise _GeminiCallFailed
+
+def call_gemini_api(prompt: str, response_schema_json: str | None = None) -> str | None:
+    """Makes a request to the Gemini API with retry logic and caching.
+
+    `response_schema_json` is the schema serialized with sorted keys so it hashes
+    stably as part of the cache key.
+    """
+    try:
+        return _call_gemini_api(prompt, response_schema_json)
+    except _GeminiCallFailed:
+        return None
 
 # ──────────────────────────────────────────────────────────────────────────────
 # BACKEND: JSON agent + readable summary
@@ -117,34 +259,42 @@ def call_gemini_api(prompt: str, response_schema: dict | None = None, max_retrie
 def _coerce_json(s: str) -> dict | None:
     """Robustly extracts and parses a JSON object from a string."""
     if not s: return None
-    json_match = re.search(r"\{.*\}", s.strip(), re.DOTALL)
-    if json_match:
-        s = json_match.group(0)
+    # Replies requested with a JSON response schema are normally the bare object.
     try:
-        return json.loads(s)
-    except Exception as e:
-        st.warning(f"Failed to parse JSON: {e}"); return None
+        data = orjson.loads(s)
+        if isinstance(data, dict): return data
+    except orjson.JSONDecodeError:
+        pass
+    # Otherwise try each '{' in turn as the start of an object; raw_decode stops at its matching '}' so trailing prose is ignored.
+    decoder, err = json.JSONDecoder(), "no JSON object found"
+    i = s.find("{")
+    while i >= 0:
+        try:
+            return decoder.raw_decode(s, i)[0]
+        except json.JSONDecodeError as e:
+            err = e; i = s.find("{", i + 1)
+    st.warning(f"Failed to parse JSON: {err}"); return None
 
 def _truncate_text_by_lines(text: str, max_chars=8000):
     if len(text) <= max_chars: return text
-    lines, out, count = text.splitlines(), [], 0
-    for ln in lines:
-        if count + len(ln) + 1 > max_chars: break
-        out.append(ln); count += len(ln) + 1
-    return "\n".join(out) + "\n\n…(truncated)"
-
-@st.cache_data(show_spinner=False)
+    # Cut at the last line break inside the budget; if there is none past the start, hard-cut so the prompt is never empty.
+    cut = text.rfind("\n", 0, max_chars)
+    if cut <= 0: cut = max_chars
+    return text[:cut] + "\n\n…(truncated)"
+
+SUMMARY_SCHEMA = {"type":"OBJECT","properties":{
+                    "document_title":{"type":"STRING"},
+                    "author":{"type":"STRING"},
+                    "date":{"type":"STRING"},
+                    "summary":{"type":"STRING"},
+                    "key_points":{"type":"ARRAY","items":{"type":"STRING"}}},
+                  "required":["document_title","summary","key_points"]}
+SUMMARY_SCHEMA_JSON = orjson.dumps(SUMMARY_SCHEMA, option=orjson.OPT_SORT_KEYS).decode()
+
+# Not cached itself: the Gemini call underneath is, and caching here too would pin a failed (None) result forever.
 def document_to_json_agent(doc_text: str, doc_language: str) -> dict | None:
     if not doc_text: st.warning("No text for JSON extraction."); return None
     
-    schema = {"type":"OBJECT","properties":{
-                "document_title":{"type":"STRING"},
-                "author":{"type":"STRING"},
-                "date":{"type":"STRING"},
-                "summary":{"type":"STRING"},
-                "key_points":{"type":"ARRAY","items":{"type":"STRING"}}},
-              "required":["document_title","summary","key_points"]}
-    
     prompt_text = _truncate_text_by_lines(doc_text, 8000)
     prompt = (
         f"You are a highly efficient AI agent. Your task is to extract key information from a document and return a STRICT JSON object.\n"
@@ -158,7 +308,7 @@ def document_to_json_agent(doc_text: str, doc_language: str) -> dict | None:
         f"**Strict JSON Output:**"
     )
 
-    raw = call_gemini_api(prompt, response_schema=schema)
+    raw = call_gemini_api(prompt, response_schema_json=SUMMARY_SCHEMA_JSON)
     data = _coerce_json(raw)
     if data: return data
     st.error("Failed to parse model output as JSON.")
@@ -183,7 +333,10 @@ def json_to_readable(structured: dict) -> str:
 st.set_page_config(page_title="CLARITY FORGE — From Chaos to Clarity", page_icon="🧠", layout="wide",
                    initial_sidebar_state="collapsed")
 
-st.markdown(f"""
+@st.cache_resource(show_spinner=False)
+def _page_chrome_html() -> str:
+    """Global styles and hero markup; depends only on constants, so it is formatted once per process."""
+    return f"""
 <style>
 @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700;800;900&family=Space+Grotesk:wght@300;400;500;600;700&display=swap');
 
@@ -857,7 +1010,9 @@ header {{visibility: hidden;}}
         </div>
     </div>
 </div>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(_page_chrome_html(), unsafe_allow_html=True)
 
 # Main Application Card
 st.markdown('<div class="main-card fade-in-up">', unsafe_allow_html=True)
@@ -869,18 +1024,20 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
-ocr_language_options = {"English":"eng","Spanish":"spa","French":"fra","Tamil":"tam","Auto-detect":"auto"}
 colA, colB = st.columns([2,1])
 with colA:
-    selected_language_name = st.selectbox("Select document language for OCR", list(ocr_language_options.keys()), index=0)
+    selected_language_name = st.selectbox("Select document language for OCR", OCR_LANG_NAMES, index=0)
 with colB:
     st.write(""); st.markdown('<div class="small">Max 200MB · PDF, JPG · PNG</div>', unsafe_allow_html=True)
 
-ocr_language_code = ocr_language_options[selected_language_name]
+ocr_language_code = OCR_LANG_MAP[selected_language_name]
 uploaded_file = st.file_uploader("Choose a PDF or Image file", type=["pdf","jpg","jpeg","png"])
 
 if uploaded_file is not None:
-    uploaded_file.seek(0)
+    # Only a new upload has extraction to overlap with; later reruns hit the caches.
+    if st.session_state.get("prewarmed_file_id") != uploaded_file.file_id:
+        st.session_state.prewarmed_file_id = uploaded_file.file_id
+        _prewarm_gemini_connection()
     # Store extracted_text in session state
     st.session_state.extracted_text = extract_text_from_document(uploaded_file, uploaded_file.type, ocr_language_code)
     # Reset chat history when a new file is uploaded
@@ -898,8 +1055,18 @@ if uploaded_file is not None:
             # Use a collapsible expander for raw text
             st.markdown("---")
             st.markdown("### 📝 Raw Extracted Text")
-            with st.expander("Click to view the full extracted text"):
-                st.text(st.session_state.extracted_text)
+            # Every rerun resends this element over the websocket, so very long OCR output is capped here.
+            extracted_text = st.session_state.extracted_text
+            truncated = len(extracted_text) > RAW_TEXT_DISPLAY_CHARS
+            expander_label = (f"Click to view the first {RAW_TEXT_DISPLAY_CHARS:,} characters of the extracted text"
+                              if truncated else "Click to view the full extracted text")
+            with st.expander(expander_label):
+                if truncated:
+                    st.text(extracted_text[:RAW_TEXT_DISPLAY_CHARS] + "\n… [truncated for display]")
+                    st.download_button("Download full text", extracted_text.encode("utf-8"), file_name="extracted.txt",
+                                       mime="text/plain", on_click="ignore")
+                else:
+                    st.text(extracted_text)
 
             st.markdown("#### Structured JSON")
             pretty = json.dumps(structured_data, indent=2, ensure_ascii=False)
@@ -0,0 +1,37 @@
+"""Process-pool workers for page-parallel Tesseract OCR.
+
+These live outside app.py because Streamlit executes the app script as
+`__main__`, which child processes cannot import back; functions defined here
+pickle by module reference under any multiprocessing start method.
+"""
+import os
+import pytesseract
+
+_ocr_language = "eng"
+
+def init_worker(ocr_language: str, tesseract_cmd: str) -> None:
+    """Runs once per pool process before any page is handed to it."""
+    global _ocr_language
+    # One page per core already saturates the CPU; Tesseract's own OpenMP threads would only oversubscribe it.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    _ocr_language = ocr_language
+
+def ocr_page_list(list_path: str) -> list[str]:
+    """OCRs every page image named in a Tesseract list file with a single Tesseract run, one text per page.
+
+    Tesseract reads the files itself, so nothing is decoded in Python; page images are deleted once done.
+    """
+    with open(list_path) as f:
+        page_paths = f.read().splitlines()
+    text = pytesseract.image_to_string(list_path, lang=_ocr_language, config="--oem 1")
+    for page_path in page_paths:
+        os.remove(page_path)
+    # Tesseract separates the pages of a multi-page run with form feeds (older versions also end the last page
+    # with one). Any other count means an image was skipped, and the texts would no longer match their pages.
+    texts = text.split("\f")
+    if len(texts) == len(page_paths) + 1 and not texts[-1].strip():
+        texts.pop()
+    if len(texts) != len(page_paths):
+        raise RuntimeError(f"Tesseract returned {len(texts)} page(s) for {len(page_paths)} image(s)")
+    return texts